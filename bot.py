@@ -1,170 +1,345 @@
 import os
 import math
 import re
+import sys
+import time
+import asyncio
+import bisect
+import contextlib
+import functools
+import logging
 import urllib.parse
-from datetime import datetime, timezone
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import NamedTuple
 
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from dotenv import load_dotenv
 import httpx
+import orjson
 from aiohttp import web
 
+log = logging.getLogger(__name__)
+
 # Load env
 ENV_PATH = Path(__file__).resolve().with_name(".env")
 load_dotenv(dotenv_path=ENV_PATH)
 
-TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-SHEET_URL = os.getenv("GOOGLE_SHEET_CSV_URL") or os.getenv("GOOGLE_SHEET_URL")
-BASE_URL = os.getenv("BASE_URL")
-
-if not TOKEN or not SHEET_URL or not BASE_URL:
+# All settings are read from the environment once, here
+@dataclass(frozen=True)
+class Config:
+    token: str = field(repr=False)  # keep the bot token out of logs
+    sheet_url: str
+    base_url: str
+    port: int
+    timeout: float = 10.0
+
+    @functools.cached_property
+    def csv_url(self) -> str:
+        return derive_csv_url(self.sheet_url)
+
+CFG = Config(
+    token=os.getenv("TELEGRAM_BOT_TOKEN"),
+    sheet_url=os.getenv("GOOGLE_SHEET_CSV_URL") or os.getenv("GOOGLE_SHEET_URL"),
+    base_url=os.getenv("BASE_URL"),
+    port=int(os.getenv("PORT", 5000)),
+)
+
+if not CFG.token or not CFG.sheet_url or not CFG.base_url:
     raise RuntimeError("Missing TELEGRAM_BOT_TOKEN, GOOGLE_SHEET_URL, or BASE_URL in environment")
 
-TIMEOUT = 10.0
+RATE_TTL = 120  # seconds a fetched rate is reused before hitting the sheet again
+RATE_REFRESH = 60  # background refresh period; shorter than RATE_TTL so the cache never goes cold
+CSV_READ_LIMIT = 64 * 1024  # never read more of the sheet than this looking for the rate
 
 AGENT_PHONE = "+79938916814"
+AGENT_DIGITS = AGENT_PHONE.lstrip("+")
+WA_LINK_PREFIX = f"https://wa.me/{AGENT_DIGITS}?text="
 
 # -------------------- Fee table (Kwacha) --------------------
+class Bracket(NamedTuple):
+    lo: int
+    hi: int
+    fee: int
+
 FEE_BRACKETS = [
-    (100,    450,    25),
-    (500,    1500,   50),
-    (1600,   3400,   100),
-    (3500,   6400,   150),
-    (6500,   10000,  325),
-    (10001,  15000,  500),
-    (15001,  20000,  700),
-    (20001,  40000,  1000),
+    Bracket(100,    450,    25),
+    Bracket(500,    1500,   50),
+    Bracket(1600,   3400,   100),
+    Bracket(3500,   6400,   150),
+    Bracket(6500,   10000,  325),
+    Bracket(10001,  15000,  500),
+    Bracket(15001,  20000,  700),
+    Bracket(20001,  40000,  1000),
 ]
-MIN_K = FEE_BRACKETS[0][0]
-MAX_K = FEE_BRACKETS[-1][1]
+MIN_K = FEE_BRACKETS[0].lo
+MAX_K = FEE_BRACKETS[-1].hi
+
+# Bracket columns for bisect lookups (FEE_BRACKETS is sorted and non-overlapping)
+_LOS = [b.lo for b in FEE_BRACKETS]
+_HIS = [b.hi for b in FEE_BRACKETS]
+_FEES = [b.fee for b in FEE_BRACKETS]
 
+# Display strings per bracket, indexed like FEE_BRACKETS
+_RANGE_STRS = [f"{lo:,}–{hi:,}" for lo, hi, _ in FEE_BRACKETS]
+_BRACKET_LINES = [f"{lo:,}–{hi:,} K → <b>{fee:,} K</b>" for lo, hi, fee in FEE_BRACKETS]
+
+# Returns (fee, bracket index), or (None, None) if the amount falls in no bracket
+@functools.lru_cache(maxsize=256)
 def fee_for_kw(amount_k: float):
-    for lo, hi, fee in FEE_BRACKETS:
-        if lo <= amount_k <= hi:
-            return fee, (lo, hi)
+    i = bisect.bisect_left(_HIS, amount_k)
+    if i < len(_HIS) and _LOS[i] <= amount_k:
+        return _FEES[i], i
     return None, None
 
+@functools.lru_cache(maxsize=256)
 def fmt_money(x, cur=""):
-    s = f"{x:,.2f}"
-    if s.endswith(".00"):
-        s = s[:-3]
-    return f"{s} {cur}".strip()
-
+    if math.isfinite(x) and x == int(x):
+        s = f"{int(x):,}"
+    else:
+        s = f"{x:,.2f}"
+        if s.endswith(".00"):  # e.g. 1.999 rounds to "2.00"
+            s = s[:-3]
+    return f"{s} {cur}".rstrip()
+
+# Drop spaces (incl. non-breaking ones users paste) and accept "," as decimal point
+_AMOUNT_TRANS = str.maketrans({",": ".", " ": None, "\u00a0": None})
+
+@functools.lru_cache(maxsize=256)
 def parse_amount(text: str) -> float:
-    t = text.replace(" ", "").replace(",", ".")
-    return float(t)
+    x = float(text.translate(_AMOUNT_TRANS))
+    if not math.isfinite(x):  # float() accepts "inf", "nan", "1e309"
+        raise ValueError(f"Not a finite amount: {text!r}")
+    return x
 
 # -------------------- Google Sheet rate (ZMW->RUB) --------------------
-def derive_csv_url(url: str) -> str:
+_SHEET_ID_RE = re.compile(r"/spreadsheets/d/([a-zA-Z0-9-_]+)")
+_NUMBER_RE = re.compile(rb'[-+]?\d+(?:[.,]\d+)?')
+
+def _with_csv_output(url: str) -> str:
+    # Plain append in the common case; only round-trip the query when it already
+    # carries an output= parameter (or the URL has a fragment) that must be replaced
+    if "output=" not in url and "#" not in url:
+        return url + ("&" if "?" in url else "?") + "output=csv"
     parsed = urllib.parse.urlparse(url)
-    path = parsed.path
     q = dict(urllib.parse.parse_qsl(parsed.query))
+    q["output"] = "csv"
+    return urllib.parse.urlunparse(parsed._replace(query=urllib.parse.urlencode(q)))
+
+@functools.lru_cache(maxsize=8)
+def derive_csv_url(url: str) -> str:
+    path = url.split("?", 1)[0].split("#", 1)[0]
     if "/spreadsheets/d/e/" in path and "/pubhtml" in path:
-        path = path.replace("/pubhtml", "/pub")
-        q["output"] = "csv"
-        new_q = urllib.parse.urlencode(q)
-        return urllib.parse.urlunparse(parsed._replace(path=path, query=new_q))
+        return _with_csv_output(url.replace("/pubhtml", "/pub", 1))
     if "/spreadsheets/d/e/" in path and "/pub" in path:
-        q["output"] = "csv"
-        new_q = urllib.parse.urlencode(q)
-        return urllib.parse.urlunparse(parsed._replace(query=new_q))
-    m = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", path)
+        return _with_csv_output(url)
+    m = _SHEET_ID_RE.search(path)
     if m:
         sheet_id = m.group(1)
-        gid = q.get("gid", "0")
+        gid = "0"
+        if "gid=" in url:
+            gid = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(url).query)).get("gid", "0")
         return f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid}"
     return url
 
-CSV_URL = derive_csv_url(SHEET_URL)
-
-async def fetch_rate_from_sheet():
-    async with httpx.AsyncClient(timeout=TIMEOUT, follow_redirects=True) as client:
-        r = await client.get(CSV_URL, headers={"Accept": "text/csv"})
+HTTP = httpx.AsyncClient(
+    timeout=CFG.timeout,
+    follow_redirects=True,
+    http2=True,  # Google serves the sheet over HTTP/2; needs the httpx[http2] extra
+    limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=60),
+)
+
+class Rate(NamedTuple):
+    rub_per_zmw: float
+    zmw_per_rub: float
+    rub_str: str  # rub_per_zmw formatted for display
+    zmw_str: str  # zmw_per_rub formatted for display
+    updated: str
+
+CSV_HEADERS = {"Accept": "text/csv"}
+
+_rate_cache = {"value": None, "expires": 0.0}
+_rate_inflight = None  # download task shared by every caller that misses the cache
+_rate_refresher = None  # background task started in on_startup
+
+async def _download_rate():
+    # Read the CSV as raw bytes and stop as soon as the first number is complete
+    # (two bytes past the match are enough to rule out a trailing ",5" / ".5")
+    buf = bytearray()
+    async with HTTP.stream("GET", CFG.csv_url, headers=CSV_HEADERS) as r:
         r.raise_for_status()
-        txt = r.text.strip()
-        m = re.search(r'[-+]?\d+(?:[.,]\d+)?', txt)
-        if not m:
-            raise RuntimeError(f"Could not parse rate from: {txt[:80]}")
-        rub_per_zmw = float(m.group(0).replace(',', '.'))
-        updated = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
-        return rub_per_zmw, updated
+        if r.headers.get("content-type", "").startswith("text/html"):
+            # Google answers with a sign-in/HTML page when the sheet isn't published as CSV
+            raise RuntimeError("Sheet returned HTML instead of CSV; is it published to the web?")
+        async for chunk in r.aiter_bytes():
+            buf += chunk
+            m = _NUMBER_RE.search(buf)
+            if (m and len(buf) - m.end() >= 2) or len(buf) >= CSV_READ_LIMIT:
+                break
+    del buf[CSV_READ_LIMIT:]
+    m = _NUMBER_RE.search(buf)
+    if not m:
+        raise RuntimeError(f"Could not parse rate from: {bytes(buf[:80]).decode(errors='replace').strip()}")
+    rub_per_zmw = float(m.group(0).replace(b',', b'.').decode())
+    zmw_per_rub = 1 / rub_per_zmw if rub_per_zmw else math.inf
+    updated = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime())
+    return Rate(rub_per_zmw, zmw_per_rub, f"{rub_per_zmw:.4f}", f"{zmw_per_rub:.4f}", updated)
+
+async def _refill_rate():
+    global _rate_inflight
+    try:
+        value = await _download_rate()
+        _rate_cache["value"] = value
+        _rate_cache["expires"] = time.monotonic() + RATE_TTL
+        return value
+    finally:
+        _rate_inflight = None
+
+async def fetch_rate_from_sheet(force=False):
+    global _rate_inflight
+    if not force and time.monotonic() < _rate_cache["expires"]:
+        return _rate_cache["value"]
+    # Single-flight: concurrent misses all await the same download; a failure
+    # is raised to every waiter and the next call starts a fresh attempt
+    if _rate_inflight is None:
+        _rate_inflight = asyncio.create_task(_refill_rate())
+    # shield() so one cancelled handler doesn't abort the fetch for the others
+    return await asyncio.shield(_rate_inflight)
+
+async def _refresh_rate_forever():
+    # Keeps the cache warm so handlers never wait on Google; on failure the last
+    # good rate is served until RATE_TTL runs out and handlers fetch themselves
+    while True:
+        try:
+            await fetch_rate_from_sheet(force=True)
+        except Exception:
+            log.exception("Background rate refresh failed")
+        await asyncio.sleep(RATE_REFRESH)
 
 # -------------------- UI --------------------
-def menu_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="📈 Google rate")],
-            [KeyboardButton(text="💸 Receive Kwacha"), KeyboardButton(text="💶 Receive Rubles")],
-            [KeyboardButton(text="ℹ️ Fees")],
-        ],
-        resize_keyboard=True
-    )
+# Menu button labels; shared by the keyboard, the handler filters and the webhook fast path
+BTN_RATE = "📈 Google rate"
+BTN_KW = "💸 Receive Kwacha"
+BTN_RUB = "💶 Receive Rubles"
+BTN_FEES = "ℹ️ Fees"
+
+MENU_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text=BTN_RATE)],
+        [KeyboardButton(text=BTN_KW), KeyboardButton(text=BTN_RUB)],
+        [KeyboardButton(text=BTN_FEES)],
+    ],
+    resize_keyboard=True
+)
+
+FEE_TABLE_TEXT = "<b>📋 Fee table (Kwacha)</b>\n" + "\n".join(_BRACKET_LINES)
 
 def header(title): return f"<b>{title}</b>\n"
 
-def line(label, value, width=18): return f"{label:<{width}} {value}\n"
-
-def calc_block(pairs): return f"<pre>{''.join(line(k,v) for k,v in pairs)}</pre>"
+START_TEXT = (
+    header("🚀 MONEY TRANSFER — Quick Menu") +
+    "Use the buttons below anytime:\n"
+    "• 📈 Google rate — show ZMW↔RUB\n"
+    "• 💸 Receive Kwacha — enter K to pay out (we add fee & show RUB to send)\n"
+    "• 💶 Receive Rubles — enter RUB to pay out (we add fee in K)\n"
+    "• ℹ️ Fees — see fee brackets"
+)
+KW_PROMPT_TEXT = (
+    header("💸 Receive Kwacha") +
+    f"Enter the Kwacha amount the recipient should get ({MIN_K}–{MAX_K} K)."
+)
+RUB_PROMPT_TEXT = header("💶 Receive Rubles") + "Enter the Ruble amount the client should get, e.g. 10000."
+RATE_TMPL = (
+    header("📈 Current Google rate") +
+    "<b>1 ZMW → RUB:</b> %s\n"
+    "<b>1 RUB → ZMW:</b> %s\n"
+    "<b>Updated:</b> %s\n"
+    "<b>Source:</b> Google Sheet"
+)
+
+def _rate_text(rate): return RATE_TMPL % (rate.rub_str, rate.zmw_str, rate.updated)
 
 # -------------------- FSM --------------------
 class Form(StatesGroup):
     waiting_kw_amount = State()
     waiting_rub_amount = State()
 
+# Plain per-(chat, user) dicts; enough for a single-process bot with two states
+class DictStorage(BaseStorage):
+    def __init__(self):
+        self._states = {}
+        self._data = {}
+
+    async def set_state(self, key, state=None):
+        k = (key.chat_id, key.user_id)
+        if state is None:
+            self._states.pop(k, None)
+        else:
+            self._states[k] = state.state if isinstance(state, State) else state
+
+    async def get_state(self, key):
+        return self._states.get((key.chat_id, key.user_id))
+
+    async def set_data(self, key, data):
+        k = (key.chat_id, key.user_id)
+        if data:
+            self._data[k] = dict(data)
+        else:
+            self._data.pop(k, None)
+
+    async def get_data(self, key):
+        return dict(self._data.get((key.chat_id, key.user_id), {}))
+
+    async def close(self):
+        pass
+
 # -------------------- BOT --------------------
-bot = Bot(TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-dp = Dispatcher(storage=MemoryStorage())
+def orjson_dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
+
+# Keeps idle connections to api.telegram.org open longer than aiohttp's 15s default
+# so replies reuse a warm TLS session. aiogram has no public option for this; it
+# relies on AiohttpSession._connector_init (aiogram 3.x, checked on 3.31) and
+# falls back to the default pool if that attribute ever goes away.
+class KeepAliveSession(AiohttpSession):
+    def __init__(self, keepalive_timeout=60, **kwargs):
+        super().__init__(**kwargs)
+        connector_init = getattr(self, "_connector_init", None)
+        if isinstance(connector_init, dict):
+            connector_init["keepalive_timeout"] = keepalive_timeout
+
+session = KeepAliveSession(json_loads=orjson.loads, json_dumps=orjson_dumps)
+bot = Bot(CFG.token, session=session, default=DefaultBotProperties(parse_mode="HTML"))
+dp = Dispatcher(storage=DictStorage())
 
 @dp.message(Command("start"))
 async def start_cmd(m: Message, state: FSMContext):
     await state.clear()
-    await m.answer(
-        header("🚀 MONEY TRANSFER — Quick Menu") +
-        "Use the buttons below anytime:\n"
-        "• 📈 Google rate — show ZMW↔RUB\n"
-        "• 💸 Receive Kwacha — enter K to pay out (we add fee & show RUB to send)\n"
-        "• 💶 Receive Rubles — enter RUB to pay out (we add fee in K)\n"
-        "• ℹ️ Fees — see fee brackets",
-        reply_markup=menu_keyboard()
-    )
+    await m.answer(START_TEXT, reply_markup=MENU_KB)
 
-@dp.message(F.text == "ℹ️ Fees")
+@dp.message(F.text == BTN_FEES)
 async def fees(m: Message, state: FSMContext):
     await state.clear()
-    lines = ["<b>📋 Fee table (Kwacha)</b>"]
-    for lo, hi, fee in FEE_BRACKETS:
-        lines.append(f"{lo:,}–{hi:,} K → <b>{fee:,} K</b>")
-    await m.answer("\n".join(lines), reply_markup=menu_keyboard())
+    await m.answer(FEE_TABLE_TEXT, reply_markup=MENU_KB)
 
-@dp.message(F.text == "📈 Google rate")
+@dp.message(F.text == BTN_RATE)
 async def google_rate(m: Message, state: FSMContext):
     await state.clear()
-    rub_per_zmw, updated = await fetch_rate_from_sheet()
-    zmw_per_rub = 1 / rub_per_zmw if rub_per_zmw else math.inf
-    txt = header("📈 Current Google rate") + calc_block([
-        ("1 ZMW → RUB", f"{rub_per_zmw:.4f}"),
-        ("1 RUB → ZMW", f"{zmw_per_rub:.4f}"),
-        ("Updated", updated),
-        ("Source", "Google Sheet"),
-    ])
-    await m.answer(txt, reply_markup=menu_keyboard())
+    rate = await fetch_rate_from_sheet()
+    await m.answer(_rate_text(rate), reply_markup=MENU_KB)
 
 # 💸 Receive Kwacha
-@dp.message(F.text == "💸 Receive Kwacha")
+@dp.message(F.text == BTN_KW)
 async def choose_kw(m: Message, state: FSMContext):
     await state.set_state(Form.waiting_kw_amount)
-    await m.answer(
-        header("💸 Receive Kwacha") +
-        f"Enter the Kwacha amount the recipient should get ({MIN_K}–{MAX_K} K).",
-        reply_markup=menu_keyboard()
-    )
+    await m.answer(KW_PROMPT_TEXT, reply_markup=MENU_KB)
 
 @dp.message(Form.waiting_kw_amount)
 async def handle_kw(m: Message, state: FSMContext):
@@ -175,32 +350,31 @@ async def handle_kw(m: Message, state: FSMContext):
     if want_k < MIN_K or want_k > MAX_K:
         return await m.answer(f"Amount {fmt_money(want_k,'K')} is outside supported range ({MIN_K}-{MAX_K} K).")
 
-    fee_k, (lo, hi) = fee_for_kw(want_k)
-    rub_per_zmw, updated = await fetch_rate_from_sheet()
+    fee_k, bracket = fee_for_kw(want_k)
+    rate = await fetch_rate_from_sheet()
     total_k = want_k + fee_k
-    rub_to_send = total_k * rub_per_zmw
+    rub_to_send = total_k * rate.rub_per_zmw
 
     message_text = (
         f"CLIENT wants to receive {fmt_money(want_k,'ZMW')}.\n\n"
-        f"Transfer fee: {fmt_money(fee_k,'ZMW')} (because your amount is in the {lo:,}–{hi:,} range)\n"
+        f"Transfer fee: {fmt_money(fee_k,'ZMW')} (because your amount is in the {_RANGE_STRS[bracket]} range)\n"
         f"Total to send: {fmt_money(total_k,'ZMW')} including the fee\n"
-        f"Exchange rate used: 1 ZMW = {rub_per_zmw:.4f} RUB\n"
+        f"Exchange rate used: 1 ZMW = {rate.rub_str} RUB\n"
         f"Equivalent in Rubles: {fmt_money(rub_to_send,'RUB')}\n"
-        f"Updated: {updated}\n\n"
+        f"Updated: {rate.updated}\n\n"
         f"Click below to open WhatsApp to initiate the transaction 👇"
     )
 
-    encoded = urllib.parse.quote(message_text)
-    wa_link = f"https://wa.me/{AGENT_PHONE.replace('+','')}?text={encoded}"
+    wa_link = WA_LINK_PREFIX + urllib.parse.quote(message_text, safe="")
 
     await state.clear()
-    await m.answer(message_text + f"\n\n👉 <a href='{wa_link}'>Contact agent on WhatsApp</a>", reply_markup=menu_keyboard())
+    await m.answer(message_text + f"\n\n👉 <a href='{wa_link}'>Contact agent on WhatsApp</a>", reply_markup=MENU_KB)
 
 # 💶 Receive Rubles
-@dp.message(F.text == "💶 Receive Rubles")
+@dp.message(F.text == BTN_RUB)
 async def choose_rub(m: Message, state: FSMContext):
     await state.set_state(Form.waiting_rub_amount)
-    await m.answer(header("💶 Receive Rubles") + "Enter the Ruble amount the client should get, e.g. 10000.")
+    await m.answer(RUB_PROMPT_TEXT)
 
 @dp.message(Form.waiting_rub_amount)
 async def handle_rub(m: Message, state: FSMContext):
@@ -208,48 +382,119 @@ async def handle_rub(m: Message, state: FSMContext):
         want_rub = parse_amount(m.text)
     except:
         return await m.answer("Please enter a valid number, e.g. 10000.")
-    rub_per_zmw, updated = await fetch_rate_from_sheet()
-    zmw_per_rub = 1 / rub_per_zmw
-    base_k = want_rub * zmw_per_rub
-    if base_k < MIN_K or base_k > MAX_K:
+    rate = await fetch_rate_from_sheet()
+    base_k = want_rub * rate.zmw_per_rub
+    if not MIN_K <= base_k <= MAX_K:  # also catches nan (0 RUB at a zero rate)
         return await m.answer(f"The equivalent {fmt_money(base_k,'K')} is outside supported fee range.")
 
-    fee_k, (lo, hi) = fee_for_kw(base_k)
+    fee_k, bracket = fee_for_kw(base_k)
     total_k = base_k + fee_k
 
     message_text = (
         f"CLIENT wants to receive {fmt_money(want_rub,'RUB')}.\n\n"
         f"Equivalent in Kwacha: {fmt_money(base_k,'ZMW')}\n"
-        f"Transfer fee: {fmt_money(fee_k,'ZMW')} (because your amount is in the {lo:,}–{hi:,} range)\n"
+        f"Transfer fee: {fmt_money(fee_k,'ZMW')} (because your amount is in the {_RANGE_STRS[bracket]} range)\n"
         f"Total to send: {fmt_money(total_k,'ZMW')} including the fee\n"
-        f"Exchange rate used: 1 ZMW = {rub_per_zmw:.4f} RUB\n"
-        f"Updated: {updated}\n\n"
+        f"Exchange rate used: 1 ZMW = {rate.rub_str} RUB\n"
+        f"Updated: {rate.updated}\n\n"
         f"Click below to open WhatsApp to initiate the transaction 👇"
     )
 
-    encoded = urllib.parse.quote(message_text)
-    wa_link = f"https://wa.me/{AGENT_PHONE.replace('+','')}?text={encoded}"
+    wa_link = WA_LINK_PREFIX + urllib.parse.quote(message_text, safe="")
 
     await state.clear()
-    await m.answer(message_text + f"\n\n👉 <a href='{wa_link}'>Contact agent on WhatsApp</a>", reply_markup=menu_keyboard())
+    await m.answer(message_text + f"\n\n👉 <a href='{wa_link}'>Contact agent on WhatsApp</a>", reply_markup=MENU_KB)
 
 # -------------------- Webhook --------------------
+MAX_CONCURRENT_UPDATES = 64
+SEM = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+_tasks = set()  # strong refs so pending dispatches aren't garbage-collected
+_OK_HEADERS = {"Content-Length": "0"}
+SHUTDOWN_GRACE = 10  # seconds to let acked updates finish before sessions close
+
+# Static menu buttons are answered straight from the raw update dict, skipping
+# pydantic validation and the dispatcher; mirrors the fees/google_rate handlers
+async def _fast_path(data):
+    msg = data.get("message")
+    if not msg or "from" not in msg or msg.get("is_topic_message"):
+        return False
+    text = msg.get("text")
+    if text == BTN_FEES:
+        reply = FEE_TABLE_TEXT
+    elif text == BTN_RATE:
+        reply = _rate_text(await fetch_rate_from_sheet())
+    else:
+        return False
+    chat_id = msg["chat"]["id"]
+    key = StorageKey(bot_id=bot.id, chat_id=chat_id, user_id=msg["from"]["id"])
+    await dp.storage.set_state(key, None)
+    await dp.storage.set_data(key, {})
+    await bot.send_message(chat_id, reply, reply_markup=MENU_KB)
+    return True
+
+async def _dispatch(data):
+    async with SEM:
+        try:
+            if not await _fast_path(data):
+                update = types.Update.model_validate(data, context={"bot": bot})
+                await dp.feed_update(bot=bot, update=update)
+        except Exception:
+            # Nobody awaits this task, so log here instead of losing the error
+            log.exception("Failed to process update %s", data.get("update_id"))
+
 async def handle(request):
-    data = await request.json()
-    update = types.Update(**data)
-    await dp.feed_update(bot=bot, update=update)
-    return web.Response()
+    try:
+        data = orjson.loads(await request.read())
+    except orjson.JSONDecodeError:
+        raise web.HTTPBadRequest()
+    if not isinstance(data, dict):
+        # _dispatch expects an Update object; anything else isn't from Telegram
+        raise web.HTTPBadRequest()
+    # Ack Telegram right away; the update is processed in the background
+    task = asyncio.create_task(_dispatch(data))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return web.Response(status=200, headers=_OK_HEADERS)
+
+WEBHOOK_URL = f"{CFG.base_url}/{CFG.token}"
+ALLOWED_UPDATES = ["message"]  # the bot only handles messages
 
 async def on_startup(app):
-    await bot.set_webhook(f"{BASE_URL}/{TOKEN}")
+    global _rate_refresher
+    # Skip the round-trip (and webhook reset) when Telegram already has our settings
+    info = await bot.get_webhook_info()
+    if info.url != WEBHOOK_URL or info.allowed_updates != ALLOWED_UPDATES:
+        await bot.set_webhook(WEBHOOK_URL, allowed_updates=ALLOWED_UPDATES)
+    _rate_refresher = asyncio.create_task(_refresh_rate_forever())
+
+async def on_shutdown(app):
+    # Updates are acked before they're processed, so Telegram won't resend them;
+    # finish what's in flight before on_cleanup closes the sessions
+    if _tasks:
+        await asyncio.wait(set(_tasks), timeout=SHUTDOWN_GRACE)
 
 async def on_cleanup(app):
+    # Stop the refresher and any shielded download before HTTP is closed under them
+    for task in (_rate_refresher, _rate_inflight):
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await task
     await bot.session.close()
+    await HTTP.aclose()
 
 app = web.Application()
-app.router.add_post(f"/{TOKEN}", handle)
+app.router.add_post(f"/{CFG.token}", handle)
 app.on_startup.append(on_startup)
+app.on_shutdown.append(on_shutdown)
 app.on_cleanup.append(on_cleanup)
 
 if __name__ == "__main__":
-    web.run_app(app, port=int(os.environ.get("PORT", 5000)))
+    # WARNING, not INFO: aiogram logs every handled update and httpx every request
+    # at INFO, which would put a stderr write on the event loop per update
+    logging.basicConfig(level=logging.WARNING)
+    loop = None
+    if sys.platform != "win32":  # uvloop doesn't support Windows
+        import uvloop
+        loop = uvloop.new_event_loop()
+    web.run_app(app, port=CFG.port, access_log=None, loop=loop)